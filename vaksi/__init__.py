@@ -1,8 +1,10 @@
 from typing import Type
 
 import asyncio
-from collections import deque
-from mautrix.errors.request import MNotFound, MatrixStandardRequestError
+import copy
+import re
+import time
+from mautrix.errors.request import MatrixStandardRequestError
 from mautrix.types import Format, MessageType, TextMessageEventContent
 from mautrix.util import markdown
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
@@ -12,12 +14,38 @@ from maubot import Plugin, MessageEvent
 from aiohttp.web import Request, Response, json_response
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 BOT_HELLO_STATE = 'fi.hacklab.vaksi.hello'
 
+# Precompiled; these run against every NOTICE. The display name may
+# contain parentheses, so only the trailing (!room) anchor is strict.
+FAIL_RE = re.compile(r"^Failed[^:]*:\s*(.*)$")
+CHAT_RE = re.compile(r"chat with .*\((![^)]+)\)\s*$")
+
+# The parser keeps no per-parse state, so one instance is enough
+HTML_PARSER = MaubotHTMLParser()
+
+# Prototype for the bot command; copied per use, only the body varies
+START_CHAT_PROTO = TextMessageEventContent(MessageType.TEXT)
+
+def json_reply(data) -> Response:
+    # Like json_response but with the C-implemented encoder when available
+    if orjson is not None:
+        return Response(body=orjson.dumps(data), content_type="application/json")
+    return json_response(data)
+
+def err(source: str, msg: str) -> Response:
+    return json_reply({"error": msg, "source": source})
+
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("bridges.slack")
         helper.copy("bridge_timeout")
+        helper.copy("queue_limit")
         helper.copy("link_previews")
         helper.copy("hello.plain")
         helper.copy("hello.html")
@@ -32,59 +60,162 @@ class SlackException(Exception):
 class Vaksi(Plugin):
     async def start(self) -> None:
         self.config.load_and_update()
-        self.log.debug("Slack-bridge on %s", self.config["bridges.slack"])
+        self.cache_config()
+        self.hello_content = await self.craft_message(self.hello)
+        self.log.debug("Slack-bridge on %s", self.bridge_mxids["slack"])
         self.log.debug("Webbiappis on %s", self.webapp_url)
-        self.queues = {"slack": deque()}
+        # Bounded so a stalled bridge fails fast instead of hoarding memory
+        self.queues = {"slack": asyncio.Queue(maxsize=self.queue_limit)}
         self.sinks = {"slack": None}
-        self.gc_preventer = {"slack": None}
+        # Consumer-owned acknowledgement of the in-flight act; resolved
+        # only by match_request and panic_flush, never by the caller.
+        self.acks = {"slack": None}
+        # After a panic flush the flushed request's reply may still be on
+        # its way; hold new acts back until this deadline has passed.
+        self.cooldowns = {"slack": 0.0}
+        self.consumers = {"slack": asyncio.create_task(self.run_queue("slack"))}
+        # The appservice DM practically never changes, so cache the
+        # m.direct account data for a while instead of a round-trip per call.
+        self._dm_cache = None
+        self._dm_ttl = 30.0
+        self._dm_inflight = None
+        # Rooms waiting for a hello reply. Kept in memory so the per-message
+        # path needs no Matrix round-trips; account data is still written as
+        # a best effort record, but a restart drops pending hellos.
+        self.pending_hello = set()
+        self.background_tasks = set()
 
     async def stop(self) -> None:
-        pass
+        for consumer in self.consumers.values():
+            consumer.cancel()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
-    def try_fire(self, queue) -> None:
-        if self.sinks[queue] is not None:
-            # Still processing previous
-            return
-        if not self.queues[queue]:
-            return
+    def cache_config(self) -> None:
+        # Dotted-path config lookups walk dicts on every access, so
+        # materialize the hot values once per (re)load.
+        self.bridge_mxids = {"slack": self.config["bridges.slack"]}
+        self.bridge_timeout = float(self.config["bridge_timeout"])
+        self.queue_limit = int(self.config["queue_limit"])
+        self.tokens = frozenset(self.config["tokens"] or ())
+        self.link_previews = bool(self.config["link_previews"])
+        self.hello = self.config["hello"]
+
+    async def on_external_config_update(self) -> None:
+        self.config.load_and_update()
+        self.cache_config()
+        self.hello_content = await self.craft_message(self.hello)
+
+    async def run_queue(self, queue: str) -> None:
+        # Single consumer per bridge: the bot answers messages one at a
+        # time, so fire the next act only after the previous one was
+        # acknowledged by an actual reply or a flush.
+        # Bind the per-bridge state to locals; this loop runs for every
+        # queued bot request and the dicts never change identity.
+        q = self.queues[queue]
+        sinks = self.sinks
+        acks = self.acks
+        cooldowns = self.cooldowns
+        loop = asyncio.get_running_loop()
+        while True:
+            act, sink = await q.get()
+            try:
+                # After a flush, sit out the window in which the flushed
+                # request's late reply may still arrive
+                delay = cooldowns[queue] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if sink.done():
+                    # Abandoned while queued; the act was never awaited
+                    act.close()
+                    continue
+                ack = loop.create_future()
+                sinks[queue] = sink
+                acks[queue] = ack
+                try:
+                    await act
+                except Exception as e:
+                    if not sink.done():
+                        sink.set_exception(e)
+                    # The bot never got the message, no reply will come
+                    if not ack.done():
+                        ack.set_result(None)
+                # Wait for the acknowledgement, not the sink: a caller
+                # cancelling its own future must not advance the queue
+                # while the bot's reply is still outstanding.
+                await ack
+            finally:
+                sinks[queue] = None
+                acks[queue] = None
+                q.task_done()
+
+    def sequential(self, queue: str, act) -> asyncio.Future:
+        # create_future skips the event loop policy lookup Future() does
+        response = asyncio.get_running_loop().create_future()
+        try:
+            self.queues[queue].put_nowait((act, response))
+        except asyncio.QueueFull:
+            act.close()
+            self.log.warning("Queue %s full (%d requests), rejecting", queue, self.queue_limit)
+            raise BotException("Bridge queue full, try again later")
+        return response
 
-        act, sink = self.queues[queue].popleft()
-        self.sinks[queue] = sink
-        self.gc_preventer[queue] = asyncio.create_task(act)
+    def invalidate_dm_cache(self) -> None:
+        self._dm_cache = None
 
-    def sequential(self, queue: str, act) -> None:
-        response = asyncio.Future()
-        self.queues[queue].append((act, response))
-        self.try_fire(queue)
-        return response
+    async def fetch_dms(self):
+        # Coalesce concurrent cache misses into a single Matrix fetch
+        if self._dm_inflight is not None:
+            return await self._dm_inflight
+        fut = asyncio.get_running_loop().create_future()
+        self._dm_inflight = fut
+        try:
+            all_dms = await self.client.get_account_data('m.direct')
+        except Exception as e:
+            fut.set_exception(e)
+            # Mark retrieved in case nobody else was waiting
+            fut.exception()
+            raise
+        else:
+            # Of many rooms, pick the last (most likely newest). Keeping
+            # only mxid -> room makes lookups O(1) and drops the rest.
+            latest = {mxid: rooms[-1] for mxid, rooms in all_dms.items() if rooms}
+            self._dm_cache = (time.monotonic(), latest)
+            fut.set_result(latest)
+            return latest
+        finally:
+            # If this task got cancelled mid-fetch, the future is still
+            # pending; cancel it too so coalesced waiters don't hang.
+            if not fut.done():
+                fut.cancel()
+            self._dm_inflight = None
 
     async def find_matrix_pm(self, mxid: str) -> str:
-        all_dms = await self.client.get_account_data('m.direct')
-        dm_list = all_dms.get(mxid)
-        if not dm_list:
-            return None
-        else:
-            # Of many, pick the last (most likely newest)
-            return dm_list[-1]
+        if self._dm_cache is not None:
+            ts, latest = self._dm_cache
+            if time.monotonic() - ts < self._dm_ttl:
+                return latest.get(mxid)
+        latest = await self.fetch_dms()
+        return latest.get(mxid)
 
     async def open_slack_pm(self, slack_id: str):
-        appserv = await self.find_matrix_pm(self.config["bridges.slack"])
+        appserv = await self.find_matrix_pm(self.bridge_mxids["slack"])
         if appserv is None:
+            # Maybe the PM was opened moments ago; force a fresh look next time
+            self.invalidate_dm_cache()
             raise BotException("No PM open with the Slack bot")
 
         # Make the appservice to do all the heavy lifting
-        content = TextMessageEventContent(MessageType.TEXT)
+        content = copy.copy(START_CHAT_PROTO)
         content.body = f"!slack start-chat {slack_id}"
         # The chat with the bot is sequential, so NO await here!
         act = self.client.send_message(appserv, content)
 
         try:
             # Await response first and then return both 1st and 2nd event
-            async with asyncio.timeout(self.config["bridge_timeout"]):
+            async with asyncio.timeout(self.bridge_timeout):
                 return await self.sequential("slack", act)
         except TimeoutError:
             self.log.debug("Bot response timeout while querying %s. Flushing queues", slack_id)
@@ -92,25 +223,48 @@ class Vaksi(Plugin):
             raise BotException("Timeout while communicating with the bot")
 
     def panic_flush(self, bridge: str) -> None:
-        # Exception to here is handlded by caller, so just setting it null
-        self.sinks[bridge] = None
-        while self.queues[bridge]:
-            _, sink = self.queues[bridge].popleft()
-            sink.set_exception(BotException("Panic flush due to previous timeout"))
+        # A reply to the flushed request may still arrive and must not
+        # satisfy a fresh one; keep the bridge idle for a full timeout
+        # window so any such straggler lands while nothing is in flight.
+        self.cooldowns[bridge] = time.monotonic() + self.bridge_timeout
+        # Resolve the in-flight sink so the consumer moves on. The caller
+        # has timed out already, so nobody cares about the value.
+        sink = self.sinks[bridge]
+        if sink is not None and not sink.done():
+            sink.set_exception(BotException("Panic flush due to timeout"))
+        ack = self.acks[bridge]
+        if ack is not None and not ack.done():
+            ack.set_result(None)
+        q = self.queues[bridge]
+        while not q.empty():
+            act, sink = q.get_nowait()
+            act.close()
+            if not sink.done():
+                sink.set_exception(BotException("Panic flush due to previous timeout"))
+            q.task_done()
+
+    def fire_and_forget(self, coro) -> None:
+        # Keep a reference until done so the task isn't GC'd mid-flight
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.reap_background)
+
+    def reap_background(self, task) -> None:
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.log.warning("Background task failed: %r", task.exception())
 
     async def clear_hello(self, room_id: str) -> bool:
-        try:
-            ans = await self.client.get_account_data(BOT_HELLO_STATE, room_id)
-            hello = bool(ans)
-        except MNotFound:
-            hello = False
+        hello = room_id in self.pending_hello
         if hello:
-            # Remove the flag
-            await self.client.set_account_data(BOT_HELLO_STATE, None, room_id)
+            self.pending_hello.discard(room_id)
+            # Remove the flag; the handler doesn't need to wait for it
+            self.fire_and_forget(self.client.set_account_data(BOT_HELLO_STATE, None, room_id))
         return hello
 
     async def set_hello(self, room_id: str) -> None:
-        await self.client.set_account_data(BOT_HELLO_STATE, {"hello": True}, room_id)
+        self.pending_hello.add(room_id)
+        self.fire_and_forget(self.client.set_account_data(BOT_HELLO_STATE, {"hello": True}, room_id))
 
     async def craft_message(self, data):
         plain = data.get('plain')
@@ -120,12 +274,13 @@ class Vaksi(Plugin):
         if md is not None:
             if html is not None:
                 raise BotException("Do not provide both md and html")
-            html = markdown.render(md)
+            # Pure-Python CPU work; don't block the event loop with it
+            html = await asyncio.to_thread(markdown.render, md)
         elif html is None and plain is None:
             raise BotException("Invalid combination of inputs")
 
         if plain is None:
-            plain = (await MaubotHTMLParser().parse(html)).text
+            plain = (await HTML_PARSER.parse(html)).text
 
         if html is None:
             content = TextMessageEventContent(MessageType.TEXT)
@@ -136,28 +291,32 @@ class Vaksi(Plugin):
             content.body = plain
 
         # Link previews
-        if not self.config["link_previews"]:
+        if not self.link_previews:
             content["com.beeper.linkpreviews"] = []
 
         return content
 
     def match_request(self, bridge: str, evt: MessageEvent):
-        correct = self.config["bridges"][bridge]
+        correct = self.bridge_mxids[bridge]
         if evt.sender != correct:
             self.log.debug("Incorrect user %s sent bot-like message, ignoring. Event ID: %s", evt.sender, evt.event_id)
             return None
-        sink = self.sinks[bridge]
-        if sink is None:
+        ack = self.acks[bridge]
+        if ack is None:
             self.log.debug("Unexpected bot response ignored. Event ID: %s", evt.event_id)
-        else:
-            # Run the next in queue
-            self.sinks[bridge] = None
-            self.try_fire(bridge)
+            return None
+        if not ack.done():
+            # The in-flight act got its reply; the consumer may advance
+            ack.set_result(None)
+        sink = self.sinks[bridge]
+        if sink is None or sink.done():
+            self.log.debug("Bot response to an abandoned request ignored. Event ID: %s", evt.event_id)
+            return None
         return sink
 
     def auth(self, req: Request) -> None:
         key = req.headers.get("authorization")
-        valids = self.config["tokens"]
+        valids = self.tokens
         if key is None:
             raise BotException("Authorization header missing")
         if not valids:
@@ -165,13 +324,13 @@ class Vaksi(Plugin):
         if key not in valids:
             raise BotException("Unauthorized")
 
-    @command.passive("^Failed.*: (.*)$", msgtypes=[MessageType.NOTICE])
+    @command.passive(FAIL_RE, msgtypes=[MessageType.NOTICE])
     async def collect_error(self, evt: MessageEvent, match: tuple[str]) -> None:
         req = self.match_request("slack", evt)
         if req is not None:
             req.set_exception(SlackException(match[1]))
 
-    @command.passive("chat with .*(!.*)\)$", msgtypes=[MessageType.NOTICE])
+    @command.passive(CHAT_RE, msgtypes=[MessageType.NOTICE])
     async def collect_room_id(self, evt: MessageEvent, match: tuple[str]) -> None:
         req = self.match_request("slack", evt)
         if req is not None:
@@ -179,10 +338,12 @@ class Vaksi(Plugin):
 
     @command.passive("")
     async def process_incoming(self, evt: MessageEvent, match) -> None:
+        # This fires for every message, so bail out before any awaits
+        if evt.room_id not in self.pending_hello:
+            return
         need_hello = await self.clear_hello(evt.room_id)
         if need_hello:
-            content = await self.craft_message(self.config["hello"])
-            event_id = await self.client.send_message(evt.room_id, content)
+            event_id = await self.client.send_message(evt.room_id, self.hello_content)
             self.log.debug("Hello message sent to %s, event_id %s", evt.room_id, event_id)
 
     @web.get("/directs")
@@ -190,22 +351,22 @@ class Vaksi(Plugin):
         try:
             self.auth(req)
             dms = await self.client.get_account_data('m.direct')
-            return json_response(dms)
+            return json_reply(dms)
         except BotException as e:
-            return json_response({"error": str(e), "source": "bot"})
+            return err("bot", str(e))
 
     @web.get("/direct/slack/{id}")
     async def web_slack_find_pm(self, req: Request) -> Response:
         try:
             self.auth(req)
             room_id = await self.open_slack_pm(req.match_info["id"])
-            return json_response({"room": room_id})
+            return json_reply({"room": room_id})
         except MatrixStandardRequestError as e:
-            return json_response({"error": e.message, "source": "matrix"})
+            return err("matrix", e.message)
         except BotException as e:
-            return json_response({"error": str(e), "source": "bot"})
+            return err("bot", str(e))
         except SlackException as e:
-            return json_response({"error": str(e), "source": "slack"})
+            return err("slack", str(e))
 
     @web.post("/direct/slack/{id}")
     async def web_slack_pm(self, req: Request) -> Response:
@@ -213,20 +374,37 @@ class Vaksi(Plugin):
             self.auth(req)
 
             # Preparing message contents
+            raw = await req.read()
             try:
-                data = await req.json()
-            except json.JSONDecodeError as e:
+                data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            except ValueError:
                 raise BotException("Invalid JSON given")
-            content = await self.craft_message(data)
 
-            # Finding the room and posting the message
-            room_id = await self.open_slack_pm(req.match_info["id"])
+            # Craft the message while the room is being resolved; the
+            # steps are independent until send_message needs both.
+            content_task = asyncio.create_task(self.craft_message(data))
+            # Give input validation one loop turn so a bad payload is
+            # rejected before any network is spent on the bot exchange.
+            await asyncio.sleep(0)
+            if content_task.done():
+                await content_task
+            try:
+                room_id = await self.open_slack_pm(req.match_info["id"])
+            except BaseException:
+                if content_task.done():
+                    # Retrieve a possible error so it isn't logged at GC
+                    content_task.exception()
+                else:
+                    content_task.cancel()
+                raise
+            content = await content_task
+
             await self.set_hello(room_id) # Bot replies next time
             event_id = await self.client.send_message(room_id, content)
-            return json_response({"room": room_id, "event": event_id})
+            return json_reply({"room": room_id, "event": event_id})
         except MatrixStandardRequestError as e:
-            return json_response({"error": e.message, "source": "matrix"})
+            return err("matrix", e.message)
         except BotException as e:
-            return json_response({"error": str(e), "source": "bot"})
+            return err("bot", str(e))
         except SlackException as e:
-            return json_response({"error": str(e), "source": "slack"})
+            return err("slack", str(e))